@@ -3,10 +3,13 @@
 # ------------ #
 
 import streamlit as st
+from streamlit.logger import get_logger
 import pandas as pd
 import numpy as np
 import duckdb as db
-import pickle
+import geopandas as gpd
+import os
+from script import hot_store, retrieval, spatial_index, spells
 
 # --------------------- #
 # Initial Session State #
@@ -26,6 +29,8 @@ if "initialized" not in st.session_state:
     st.session_state['starting_year'] = 1951
     st.session_state['ending_year'] = st.session_state.starting_year + 1
     st.session_state['row_range'] = tuple(['USA'])
+    st.session_state['anomaly_dummy'] = 'False'
+    st.session_state['reference_period'] = (1961, 1990)
 
 # ------------ #
 # Data imports #
@@ -42,62 +47,143 @@ def load_country_list():
     country_list = pd.read_csv('./poly/country_list.csv')
     return country_list
 
-@st.cache_data(ttl=3600, show_spinner="Fetching data...")
-def load_data(geo_resolution, variable, source, weight, weight_year, row_range, col_range, time_frequency, threshold_dummy):
-    if weight == 'un':
-        weight_year = ''
+def count_query():
+    """
+    Count the data queries actually run in this session and log the count
+    """
+    st.session_state['n_queries'] = st.session_state.get('n_queries', 0) + 1
+    get_logger(__name__).info('Data queries run in this session: %d', st.session_state.n_queries)
 
-    if time_frequency in ('yearly','monthly'):
-        freq = 'monthly'
-        time_idx = pd.date_range(start=str(st.session_state.starting_year) + "-01-01",
-                                 end= str(st.session_state.ending_year) + "-12-31", freq='MS')
+# Results are cached in the hot store, keyed on the query: all the replicas share them
+# through memory maps instead of keeping private copies, and reruns do not query again
+def load_data(geo_resolution, variable, source, weight, weight_year, row_range, col_range, time_frequency, threshold_dummy, reference_period=None):
     if time_frequency == 'daily' or threshold_dummy == "True":
         freq = 'daily'
-        time_idx = pd.date_range(start=str(st.session_state.starting_year) + "-01-01",
-                                 periods=len(row_range), freq='D')
-
-    if col_range == '*':
-        cols = '*'
+        date_format = 'X%Y%m%d'
     else:
-        if geo_resolution == 'gadm0':
-            cols = str(col_range)[1:-1].replace("'", "")
-        else:
-            regions = pd.read_csv('./poly/gadm1_adm.csv')
-            cols = regions.loc[regions.GID_0.isin(col_range), 'GID_1'].tolist()
-            cols = str(cols)[1:-1].replace("'", "").replace(".", "_")
-
-    file = './data/' + geo_resolution + '_' + source + '_' + variable + '_' + weight + '_' + weight_year + '_' + freq + '.parquet'
-    
-    query = f"SELECT {cols} FROM '{file}' WHERE Date IN {row_range}"
-    imported_data = db.query(query).df()
+        freq = 'monthly'
+        date_format = 'X%Y%m'
+
+    file = retrieval.data_file(geo_resolution, source, variable, weight, weight_year, freq)
+    units = retrieval.select_units(geo_resolution, col_range)
+
+    def query():
+        count_query()
+        with db.connect() as con:
+            return retrieval.query_data(con, file, freq, units, f"Date IN {row_range}", reference_period).to_arrow_table()
+
+    with st.spinner("Fetching data..."):
+        name = os.path.splitext(os.path.basename(file))[0] + '_result'
+        imported_data = hot_store.derived(name, retrieval.dataset_files(file), query,
+                                          key=(units, row_range, reference_period)).to_pandas()
+
+    imported_data.index = pd.to_datetime(imported_data.pop('Date'), format=date_format).rename(None)
+
+    return imported_data
+
+def load_comparison(geo_resolution, variable, weight, weight_year, row_range, col_range):
+    """
+    Load the monthly series of CRU TS, ERA5 and UDelaware for the same specification
+    and compute their ensemble mean and spread, all in a single DuckDB query, cached in
+    the hot store like load_data
+
+    Parameters:
+    geo_resolution (str): Geographical resolution of the data
+    variable (str): Name of the climate variable in the file names
+    weight (str): Name of the weighting variable in the file names
+    weight_year (str): Base year of the weighting variable
+    row_range (tuple): Date labels to retrieve, within the common window of the sources
+    col_range (tuple or str): Selected GID_0 codes, or '*' for all units
+
+    Returns:
+    imported_data (pandas dataframe): Dataframe with dates as index and one column per unit
+    and series, named as unit_cru, unit_era, unit_dela, unit_mean and unit_spread
+    """
+    units = retrieval.select_units(geo_resolution, col_range)
+    files = [part for source in retrieval.COMPARISON_SOURCES
+             for part in retrieval.dataset_files(retrieval.data_file(geo_resolution, source, variable, weight, weight_year, 'monthly'))]
+
+    def query():
+        count_query()
+        with db.connect() as con:
+            return retrieval.query_comparison(con, geo_resolution, variable, weight, weight_year,
+                                              units, f"Date IN {row_range}").to_arrow_table()
 
-    imported_data.index = time_idx
+    with st.spinner("Fetching data from all sources..."):
+        name = f'{geo_resolution}_comparison_{variable}_{weight}_{weight_year}_result'
+        imported_data = hot_store.derived(name, files, query, key=(units, row_range)).to_pandas()
+
+    imported_data.index = pd.to_datetime(imported_data.pop('Date'), format='X%Y%m').rename(None)
+
+    return imported_data
+
+@st.cache_data(ttl=3600, show_spinner="Binning daily data...")
+def load_histogram(geo_resolution, variable, weight, weight_year, years, col_range, edges, bases):
+    """
+    Load the days in bin and the degree-days of every unit and year from the daily ERA5 data.
+    The whole file is binned in a single pass, cached per bin specification, so changing the
+    units or years only slices the cached histogram
+
+    Parameters:
+    geo_resolution (str): Geographical resolution of the data
+    variable (str): Name of the climate variable in the file names
+    weight (str): Name of the weighting variable in the file names
+    weight_year (str): Base year of the weighting variable
+    years (tuple): First and last year to retrieve
+    col_range (tuple or str): Selected GID_0 codes, or '*' for all units
+    edges (tuple): Increasing bin edges
+    bases (tuple): Degree-day bases
+
+    Returns:
+    imported_data (pandas dataframe): Dataframe with unit and year columns followed by one
+    column per bin and per degree-day base
+    """
+    file = retrieval.data_file(geo_resolution, 'era', variable, weight, weight_year, 'daily')
+    units = retrieval.select_units(geo_resolution, col_range)
+
+    count_query()
+    con = db.connect()
+    imported_data = retrieval.query_histogram(con, file, units, years, edges, bases).df()
+    con.close()
 
     return imported_data
 
-@st.cache_data(ttl=3600, show_spinner="Fetching shapes...")
-def load_shapes(geo_resolution):
+def load_shapes(geo_resolution, col_range):
     """
-    Load shapefiles from the repository and return a geopandas dataframe
+    Load the shapes of the selected units and return a geopandas dataframe. Only their rows
+    are read from the memory-mapped hot store, and their geometries are those of the spatial
+    index, so every process decodes the shapes once
 
     Parameters:
     geo_resolution (str): Geographical resolution of the data
+    col_range (tuple or str): Selected GID_0 codes, or '*' for all countries
 
     Returns:
-    world (geopandas dataframe): Geopandas dataframe containing the gadm0 shapes
+    world (geopandas dataframe): Geopandas dataframe containing the shapes of the units
     """
     if geo_resolution == 'gadm0':
-        layer = '0'
-        idx_name = 'GID_0'
+        layer = 'gadm0'
+    else:
+        layer = 'gadm1'
+
+    table = hot_store.geometries(layer)
+    if col_range == '*':
+        rows = np.arange(table.num_rows)
     else:
-        layer = '1'
-        idx_name = 'NAME_1'
+        rows = np.flatnonzero(np.isin(table.column('GID_0').to_numpy(zero_copy_only=False), list(col_range)))
+    shapes = table.drop_columns('geometry').take(rows).to_pandas()
+    return gpd.GeoDataFrame(shapes, geometry=spatial_index.geometries(layer)[rows], crs='EPSG:4326')
 
-    picklefile = open('./poly/gadm' + layer + '.pickle', 'rb')
-    shapes = pickle.load(picklefile)
-    shapes.index = shapes[idx_name]
-    picklefile.close()
-    return shapes.reset_index(drop=True)
+# --------- #
+# Callbacks #
+# --------- #
+
+def check_years():
+    """
+    Keep the ending year consistent with the starting year when the parameters form is applied
+    """
+    if st.session_state.ending_year < st.session_state.starting_year:
+        st.session_state.ending_year = st.session_state.starting_year
 
 # ------------- #
 # Page settings #
@@ -122,7 +208,13 @@ st.markdown("## Download Data")
 # Parameters #
 # ---------- #
 
-# Cols
+# Observation filters
+world0 = load_country_list()
+observation_list = world0.COUNTRY.unique().tolist()
+observation_list.sort()
+
+# Selectors changing the other parameters rerun the page right away; the remaining
+# parameters are batched in a form and only rerun the page on Apply
 col1, col2, col3, col4, col5 = st.columns([1,1,1.3,1.1,1])
 if st.session_state['variable'] != 'SPEI':
     subcol1, subcol2, subcol3 = st.columns([1,1,1])
@@ -135,8 +227,9 @@ with col1:
 # Variable source
 if st.session_state.variable != "SPEI":
     with col2:
-        st.selectbox('Variable source', ("CRU TS", "ERA5", "UDelaware"), index=0,
-                     help='Source of data for the selected climate variable', key='source')
+        st.selectbox('Variable source', ("CRU TS", "ERA5", "UDelaware", "Compare sources"), index=0,
+                     help='Source of data for the selected climate variable. Compare sources shows \
+                     CRU TS, ERA5 and UDelaware over their common window, with their ensemble mean and spread', key='source')
 else:
     with col2:
         st.caption("Variable source")
@@ -165,14 +258,15 @@ if st.session_state.source == 'ERA5' and st.session_state.weight_year == '2015'
     with subcol1:
         st.selectbox('Threshold', ("False", "True"),
                      help='Activate threshold customization', key='threshold_dummy')
-    # Threshold customization
+    # Spell statistics
     if st.session_state.threshold_dummy == "True":
+        if 'threshold_statistic' not in st.session_state:
+            st.session_state['threshold_statistic'] = 'days over threshold'
         with subcol2:
-            st.selectbox('Threshold type', ("percentile", "absolute"), index=0,
-                         help='Type of threshold specification', key='threshold_kind')
-        with subcol3:
-            st.number_input('Threshold', value = 90, help='Threshold value', key='threshold')
+            st.selectbox('Threshold statistic', ('days over threshold',) + spells.STATISTICS,
+                         help='Days over the threshold, or statistics of the spells of consecutive days over it', key='threshold_statistic')
 else:
+    st.session_state['threshold_dummy'] = 'False'
     st.caption("Threshold")
     st.markdown("False")
 
@@ -191,38 +285,127 @@ else:
     st.selectbox('Time frequency', ("yearly", "monthly"), index = 0,
                  help = 'Time frequency of the data', key='time_frequency')
 
-# Time period, threshold and observations
+# Histogram switch (daily data)
+if (st.session_state.variable != 'SPEI' and st.session_state.threshold_dummy == 'False' and st.session_state.source == 'ERA5'
+        and st.session_state.weight_year == '2015' and st.session_state.geo_resolution == 'gadm0'):
+    if 'histogram_dummy' not in st.session_state:
+        st.session_state['histogram_dummy'] = 'False'
+    st.selectbox('Histogram', ("False", "True"),
+                 help='Days in bin and degree-days per unit and year, from daily data', key='histogram_dummy')
+else:
+    st.session_state['histogram_dummy'] = 'False'
+
+# Time period, threshold and observations (coverage from the dataset catalog)
 if st.session_state.source == 'CRU TS':
-    min_year = 1901
-    max_year = 2022
+    coverage = retrieval.coverage('cru', 'monthly')
     source = 'cru'
 elif st.session_state.source == 'ERA5':
-    if st.session_state.time_frequency == 'daily' or st.session_state.threshold_dummy == 'True':
-        min_year = 1950
-        max_year = 2023
+    if st.session_state.time_frequency == 'daily' or st.session_state.threshold_dummy == 'True' or st.session_state.histogram_dummy == 'True':
+        coverage = retrieval.coverage('era', 'daily')
     else:
-        min_year = 1940
-        max_year = 2022
+        coverage = retrieval.coverage('era', 'monthly')
     source = 'era'
+elif st.session_state.source == 'Compare sources':
+    coverage = retrieval.coverage(retrieval.COMPARISON_SOURCES, 'monthly')
+    source = 'all'
 elif st.session_state.source == 'CSIC':
-    min_year = 1901
-    max_year = 2020
+    coverage = retrieval.coverage('spei', 'monthly')
     source = 'spei'
 else: # (UDelaware)
-    min_year = 1900
-    max_year = 2017
+    coverage = retrieval.coverage('dela', 'monthly')
     source = 'dela'
-
-col1, col2 = st.columns(2)
-# Starting year
-with col1:
-    st.slider('Starting year', min_year, max_year, key='starting_year')
-# Ending year
-with col2:
-    if st.session_state.time_frequency == 'daily' or st.session_state.threshold_dummy == 'True':
-        st.slider('Ending year', st.session_state.starting_year, max_year, key='ending_year')
+min_year = int(coverage[0][:4])
+max_year = int(coverage[1][:4])
+# Yearly data only covers complete years
+if st.session_state.time_frequency == 'yearly' or st.session_state.histogram_dummy == 'True':
+    if coverage[0][5:] != '01-01':
+        min_year += 1
+    if coverage[1][5:] != '12-31':
+        max_year -= 1
+
+# Anomaly switch
+if (st.session_state.variable != 'SPEI' and st.session_state.threshold_dummy == 'False' and source != 'all'
+        and st.session_state.histogram_dummy == 'False'):
+    if 'anomaly_dummy' not in st.session_state:
+        st.session_state['anomaly_dummy'] = 'False'
+    st.selectbox('Anomaly', ("False", "True"),
+                 help='Subtract the climatology of a reference period from the data', key='anomaly_dummy')
+
+# Unit selection mode
+if 'selection_mode' not in st.session_state:
+    st.session_state['selection_mode'] = 'Countries'
+st.radio('Select units by', ('Countries', 'Bounding box', 'Point'), horizontal=True, key='selection_mode',
+         help='Pick countries by name, all the units intersecting a bounding box, or the unit containing (or nearest to) a point')
+
+# Keep the years of the form within the coverage of the selected source
+for key in ('starting_year', 'ending_year'):
+    st.session_state[key] = min(max(st.session_state[key], min_year), max_year)
+if 'reference_period' not in st.session_state:
+    st.session_state['reference_period'] = (1961, 1990)
+st.session_state['reference_period'] = tuple(min(max(year, min_year), max_year) for year in st.session_state.reference_period)
+
+with st.form('parameters'):
+    # Threshold customization
+    if st.session_state.threshold_dummy == "True":
+        if 'spell_length' not in st.session_state:
+            st.session_state['spell_length'] = 3
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            st.selectbox('Threshold type', ("percentile", "absolute"), index=0,
+                         help='Type of threshold specification', key='threshold_kind')
+        with col2:
+            st.number_input('Threshold', help='Threshold value', key='threshold')
+        if st.session_state.threshold_statistic != 'days over threshold':
+            with col3:
+                st.number_input('Minimum spell length', min_value=1, help='Minimum number of consecutive days of a spell', key='spell_length')
+
+    col1, col2 = st.columns(2)
+    # Starting year
+    with col1:
+        st.slider('Starting year', min_year, max_year, key='starting_year')
+    # Ending year
+    with col2:
+        st.slider('Ending year', min_year, max_year, key='ending_year')
+
+    # Reference period of the anomalies
+    if (st.session_state.variable != 'SPEI' and st.session_state.threshold_dummy == 'False' and source != 'all'
+            and st.session_state.histogram_dummy == 'False' and st.session_state.anomaly_dummy == 'True'):
+        st.slider('Reference period', min_year, max_year,
+                  help='Years over which the climatology is computed', key='reference_period')
+
+    # Bins of the histogram
+    if st.session_state.histogram_dummy == 'True':
+        if 'bin_edges' not in st.session_state:
+            st.session_state['bin_edges'] = '-9, -6, -3, 0, 3, 6, 9, 12, 15, 18, 21, 24, 27, 30'
+        if 'degree_day_bases' not in st.session_state:
+            st.session_state['degree_day_bases'] = '10, 18'
+        col1, col2 = st.columns([2, 1])
+        with col1:
+            st.text_input('Bin edges', help='Increasing, comma separated; bins are closed on the left', key='bin_edges')
+        with col2:
+            st.text_input('Degree-day bases', help='Distinct, comma separated, may be empty', key='degree_day_bases')
+
+    # Geographical units
+    if st.session_state.selection_mode == 'Bounding box':
+        col1, col2, col3, col4 = st.columns(4)
+        with col1:
+            west = st.number_input('West', -180.0, 180.0, -10.0, help='Western longitude of the bounding box')
+        with col2:
+            south = st.number_input('South', -90.0, 90.0, 35.0, help='Southern latitude of the bounding box')
+        with col3:
+            east = st.number_input('East', -180.0, 180.0, 30.0, help='Eastern longitude of the bounding box')
+        with col4:
+            north = st.number_input('North', -90.0, 90.0, 60.0, help='Northern latitude of the bounding box')
+    elif st.session_state.selection_mode == 'Point':
+        col1, col2 = st.columns(2)
+        with col1:
+            lon = st.number_input('Longitude', -180.0, 180.0, 12.5, help='Longitude of the point')
+        with col2:
+            lat = st.number_input('Latitude', -90.0, 90.0, 41.9, help='Latitude of the point')
     else:
-        st.slider('Ending year', st.session_state.starting_year, max_year, key='ending_year')
+        options = st.multiselect('Countries', ['ALL'] + observation_list, default='United States', help = 'Choose the geographical units to show in the plot')
+
+    st.form_submit_button('Apply', on_click=check_years)
 
 # ------------------- #
 # Matching file names #
@@ -255,42 +438,97 @@ if st.session_state.geo_resolution == 'gadm0':
 else:
     obs_id = 'GID_1'
 
-if st.session_state.time_frequency == 'daily' or st.session_state.threshold_dummy == 'True':
-    if st.session_state.ending_year == 2023:
-        end_day = '-08-31'
+if st.session_state.time_frequency == 'daily' or st.session_state.threshold_dummy == 'True' or st.session_state.histogram_dummy == 'True':
+    if st.session_state.ending_year == int(coverage[1][:4]):
+        end_day = coverage[1][4:]
     else:
         end_day = '-12-31'
     time_range = tuple(['X' + str(x).replace('-', '') for x in pd.date_range(start=str(st.session_state.starting_year) + "-01-01",end= str(st.session_state.ending_year) + end_day).format("YYYY.MM.DD") if x != ''])
 else:
-    time_range = tuple(['X' + str(x) + str(y).rjust(2, '0') for x in range(st.session_state.starting_year, st.session_state.ending_year + 1) for y in range(1,13)])
+    if st.session_state.ending_year == int(coverage[1][:4]):
+        end_month = int(coverage[1][5:7])
+    else:
+        end_month = 12
+    time_range = tuple(['X' + str(x) + str(y).rjust(2, '0') for x in range(st.session_state.starting_year, st.session_state.ending_year + 1) for y in range(1,13)
+                        if x < st.session_state.ending_year or y <= end_month])
 
-# Observation filters
-world0 = load_country_list()
-observation_list = world0.COUNTRY.unique().tolist()
-observation_list.sort()
-options = st.multiselect('Countries', ['ALL'] + observation_list, default='United States', help = 'Choose the geographical units to show in the plot')
 
 # Build row range
-if 'ALL' in options:
-    country_range = '*'
+if st.session_state.selection_mode == 'Countries':
+    if 'ALL' in options:
+        country_range = '*'
+    else:
+        country_range = tuple(world0.loc[world0.COUNTRY.isin(options), 'GID_0'].tolist())
 else:
-    country_range = tuple(world0.loc[world0.COUNTRY.isin(options), 'GID_0'].tolist())
+    # Regions are indexed directly when their shapes are available, through their country otherwise
+    if st.session_state.geo_resolution == 'gadm1' and spatial_index.available('gadm1'):
+        index_resolution = 'gadm1'
+    else:
+        index_resolution = 'gadm0'
+    if st.session_state.selection_mode == 'Bounding box':
+        try:
+            country_range = tuple(spatial_index.bbox(index_resolution, west, south, east, north))
+        except ValueError as error:
+            st.error(str(error))
+            st.stop()
+    else:
+        country_range = tuple(spatial_index.nearest(index_resolution, lon, lat))
+    options = list(country_range)
+
+if country_range == ():
+    st.warning('No geographical unit selected')
+    st.stop()
 
 # --------- #
 # Load data #
 # --------- #
 
+# Reference period of the anomalies, if any (histograms are built from the raw daily values)
+if (variable != 'spei' and st.session_state.threshold_dummy == 'False' and source != 'all'
+        and st.session_state.histogram_dummy == 'False' and st.session_state.get('anomaly_dummy') == 'True'):
+    reference_period = tuple(st.session_state.reference_period)
+else:
+    reference_period = None
+
+# Bin specification of the histogram, if any
+if st.session_state.histogram_dummy == 'True':
+    try:
+        histogram = (tuple(float(edge) for edge in st.session_state.bin_edges.split(',') if edge.strip() != ''),
+                     tuple(float(base) for base in st.session_state.degree_day_bases.split(',') if base.strip() != ''))
+    except ValueError:
+        st.error('Bin edges and degree-day bases must be comma separated numbers')
+        st.stop()
+    if len(histogram[0]) == 0 or any(upper <= lower for lower, upper in zip(histogram[0][:-1], histogram[0][1:])):
+        st.error('Bin edges must be increasing')
+        st.stop()
+    if len(set(histogram[1])) != len(histogram[1]):
+        st.error('Degree-day bases must be distinct')
+        st.stop()
+else:
+    histogram = None
+
 # Read data from GitHub
-data = load_data(st.session_state.geo_resolution, variable, source, weight,
-                 st.session_state.weight_year, time_range, country_range,
-                 st.session_state.time_frequency, st.session_state.threshold_dummy)
+if histogram is not None:
+    data = load_histogram(st.session_state.geo_resolution, variable, weight, st.session_state.weight_year,
+                          (st.session_state.starting_year, st.session_state.ending_year), country_range,
+                          histogram[0], histogram[1])
+elif source == 'all':
+    data = load_comparison(st.session_state.geo_resolution, variable, weight,
+                           st.session_state.weight_year, time_range, country_range)
+else:
+    data = load_data(st.session_state.geo_resolution, variable, source, weight,
+                     st.session_state.weight_year, time_range, country_range,
+                     st.session_state.time_frequency, st.session_state.threshold_dummy,
+                     reference_period)
 
 # Summarize if time frequency is yearly
-if st.session_state.time_frequency == 'yearly' and st.session_state.threshold_dummy == 'False':
+if st.session_state.time_frequency == 'yearly' and st.session_state.threshold_dummy == 'False' and histogram is None:
     if variable == 'pre':
         data = data.groupby(np.arange(data.shape[0])//12).sum()
     elif variable == 'tmp':
         data = data.groupby(np.arange(data.shape[0])//12).mean()
+    if source == 'all':
+        data = retrieval.ensemble(data)
     data.index = pd.date_range(start=str(st.session_state.starting_year) + "-01-01",end= str(st.session_state.ending_year) + "-12-31", freq='Y')
 
 elif st.session_state.threshold_dummy == 'True':
@@ -298,52 +536,83 @@ elif st.session_state.threshold_dummy == 'True':
         limit_values = data.quantile(q=st.session_state.threshold/100)
     else:
         limit_values = st.session_state.threshold
-    days_over_threshold = data.gt(limit_values, axis=1)
-    if st.session_state.time_frequency == 'yearly':
-        n_aggregate_over_threshold = days_over_threshold.groupby(by=pd.Grouper(freq="Y")).sum()
-    elif st.session_state.time_frequency == 'monthly':
-        n_aggregate_over_threshold = days_over_threshold.groupby(by=pd.Grouper(freq="M")).sum()
-    data = n_aggregate_over_threshold
+    if st.session_state.threshold_statistic == 'days over threshold':
+        days_over_threshold = data.gt(limit_values, axis=1)
+        if st.session_state.time_frequency == 'yearly':
+            n_aggregate_over_threshold = days_over_threshold.groupby(by=pd.Grouper(freq="Y")).sum()
+        elif st.session_state.time_frequency == 'monthly':
+            n_aggregate_over_threshold = days_over_threshold.groupby(by=pd.Grouper(freq="M")).sum()
+        data = n_aggregate_over_threshold
+    else:
+        data = spells.spell_statistics(data, limit_values, st.session_state.threshold_statistic,
+                                       st.session_state.spell_length, st.session_state.time_frequency)
 
 # ------------- #
 # Download data #
 # ------------- #
 
-col1, col2, col3 = st.columns(3)
-
-with col1:    
-	download_format = st.selectbox('Download format', ("Wide", "Long"), index=0)
-
-with col2:
-	download_extension = st.selectbox('Download extension', ("csv", "json"), index=0)
-
-if download_format == 'Wide':
-    data = data.T
-else:
-    data = data.reset_index()
-    data = pd.melt(data, id_vars='index', var_name='country', value_name=variable)
-
-data_show = data
+@st.fragment
+def download_section(data, variable, source, weight, reference_period, histogram):
+    """
+    Format selection, download buttons and data preview. Runs as a fragment, so
+    changing the download format only reruns this function and not the whole page
 
-if download_extension == 'csv':
-    data = data.to_csv().encode('utf-8')
-elif download_extension == 'json':
-    data = data.to_json().encode('utf-8')
+    Parameters:
+    data (pandas dataframe): Dataframe with dates as index and units as columns
+    variable (str): Name of the climate variable in the file names
+    source (str): Name of the climate source in the file names
+    weight (str): Name of the weighting variable in the file names
+    reference_period (tuple): Reference window of the anomalies, or None
+    histogram (tuple): Bin edges and degree-day bases if data is a unit x year histogram, or None
+    """
+    col1, col2, col3 = st.columns(3)
 
-with col3:
-    filename = './data/' + st.session_state.geo_resolution + '_' + source + '_' + variable + '_' + weight + '_' + st.session_state.weight_year + '_' + st.session_state.time_frequency + '.'
-    st.download_button(label = "Download data", data = data, file_name = filename + download_extension)
-with col3:
-    meta_text = 'Metadata\n' + 'Geographic resolution: ' + st.session_state.geo_resolution + '\nClimate variable source: ' + source + '\nClimate variable: ' + variable + '\nWeighting variable: ' + weight + '\nWeighting base year: '+ st.session_state.weight_year + '\n\nRemember to cite our work!\nhttps://climaterepo.streamlit.app/'
-    st.download_button(label="Download metadata", data = meta_text, file_name= 'metadata.txt')
+    with col1:    
+        download_format = st.selectbox('Download format', ("Wide", "Long"), index=0)
 
-# -------------- #
-# Visualize data #
-# -------------- #
+    with col2:
+        download_extension = st.selectbox('Download extension', ("csv", "json"), index=0)
 
-st.markdown('### Preview of the data')
-st.markdown('We are showing the first 100 rows of the data. If you want to see the full dataset, please download it.')
-st.dataframe(data_show.head(100))
+    if histogram is not None:
+        if download_format == 'Long':
+            data = pd.melt(data, id_vars=['unit', 'year'], var_name='bin', value_name=variable)
+    elif download_format == 'Wide':
+        data = data.T
+    else:
+        data = data.reset_index()
+        data = pd.melt(data, id_vars='index', var_name='country', value_name=variable)
+
+    data_show = data
+
+    if download_extension == 'csv':
+        data = data.to_csv().encode('utf-8')
+    elif download_extension == 'json':
+        data = data.to_json().encode('utf-8')
+
+    with col3:
+        filename = './data/' + st.session_state.geo_resolution + '_' + source + '_' + variable + '_' + weight + '_' + st.session_state.weight_year + '_' + st.session_state.time_frequency + '.'
+        if histogram is not None:
+            filename = filename[:-len(st.session_state.time_frequency) - 1] + 'histogram.'
+        st.download_button(label = "Download data", data = data, file_name = filename + download_extension)
+    with col3:
+        meta_text = 'Metadata\n' + 'Geographic resolution: ' + st.session_state.geo_resolution + '\nClimate variable source: ' + source + '\nClimate variable: ' + variable + '\nWeighting variable: ' + weight + '\nWeighting base year: '+ st.session_state.weight_year
+        if reference_period is not None:
+            meta_text = meta_text + '\nAnomalies with respect to: ' + str(reference_period[0]) + '-' + str(reference_period[1])
+        if histogram is not None:
+            meta_text = meta_text + '\nDaily bin edges: ' + ', '.join(f'{edge:g}' for edge in histogram[0])
+            meta_text = meta_text + '\nDegree-day bases: ' + ', '.join(f'{base:g}' for base in histogram[1])
+        meta_text = meta_text + '\n\nRemember to cite our work!\nhttps://climaterepo.streamlit.app/'
+        st.download_button(label="Download metadata", data = meta_text, file_name= 'metadata.txt')
+
+    # -------------- #
+    # Visualize data #
+    # -------------- #
+
+    st.markdown('### Preview of the data')
+    st.markdown('We are showing the first 100 rows of the data. If you want to see the full dataset, please download it.')
+    st.dataframe(data_show.head(100))
+
+download_section(data, variable, source, weight, reference_period, histogram)
 
 with st.sidebar:
     """
@@ -9,12 +9,18 @@ st.warning("Page under construction!", icon="⚠️")
 * *geo_resolution*: choose among administrative units GADM0 (countries) and GADM1 (bigger administrative units after countries);
 * *starting_year* and *ending_year*: window size. Notice that each source provides data for a peculiar time window;
 * *time_frequency*: choose among yearly or monthly climate data;
-* *source*: select source of data (available: CRU TS, UDelaware, HERA5, CSIC);
+* *source*: select source of data (available: CRU TS, UDelaware, HERA5, CSIC). *Compare sources* returns CRU TS, ERA5 and UDelaware over their common window, together with their ensemble mean and spread;
 * *variable*: select variable of interest (available: temperature, precipitation, SPEI);
 * *weight*: weight aggregation values by population density;
 * *threshold_dummy*: True or False. Number of months over a given threshold for each year in the time window;
 * *threshold_kind*: choose among a percentile or an absolute threshold;
 * *threshold*: cutoff value.
+* *threshold_statistic*: days over the threshold, or statistics of the spells of consecutive days over it (longest spell, number of spells, day of the year of the first spell onset), by year or month of onset;
+* *minimum spell length*: minimum number of consecutive days of a spell.
+* *histogram* (download page, daily data): True or False. Number of days in every bin of *bin edges* and degree-days over every *degree-day base*, per unit and year;
+* *anomaly*: True or False. Subtract from the data the monthly (or day-of-year, for daily data) climatology of each geographical unit;
+* *reference_period*: first and last year of the window over which the climatology is computed.
+* *select units by*: pick countries by name, all the units intersecting a bounding box (west, south, east and north, in degrees), or the unit containing a point (the nearest one if the point falls outside every unit).
 """
 
 # Side bar images
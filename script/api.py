@@ -0,0 +1,330 @@
+"""
+Local HTTP API serving the repository data to programmatic clients
+
+Run from the root of the repository:
+
+    python -m script.api --port 8000
+
+Endpoints:
+* GET /datasets: available data files, with their size and SHA-256;
+* GET /data: query a data file, with parameters
+    * geo_resolution: gadm0 (default) or gadm1;
+    * source: cru, era, dela or spei, or all to compare cru, era and dela;
+    * variable: tmp, pre or spei;
+    * weight: pop, lights or un;
+    * weight_year: 2000, 2005, 2010 or 2015 (ignored for un);
+    * frequency: monthly (default) or daily;
+    * units: comma separated GID_0 codes (default: all units);
+    * bbox: west,south,east,north bounding box in degrees, selecting the units intersecting it
+      instead of units;
+    * start and end: first and last date of the range, as YYYY-MM (monthly) or YYYY-MM-DD (daily);
+    * reference_start and reference_end: reference period of anomalies, in years;
+    * bins: comma separated increasing bin edges, returning the days in every bin per unit and
+      year of daily data instead of the data;
+    * degree_days: comma separated distinct degree-day bases, added to the bins;
+    * format: csv (default), json or parquet.
+
+Queries run on the same data layer as the dashboard (script/retrieval.py) and responses
+are streamed one record batch at a time. Every response carries a strong ETag derived from
+the hash of the underlying files and from the query, so clients can revalidate with
+If-None-Match and get 304 Not Modified instead of the data.
+"""
+
+import argparse
+import datetime
+import glob
+import hashlib
+import io
+import json
+import os
+
+import duckdb as db
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+import uvicorn
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.exceptions import HTTPException
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+from script import hot_store, retrieval, spatial_index
+
+BATCH_SIZE = 10000
+
+CHOICES = {
+    'geo_resolution': ('gadm0', 'gadm1'),
+    'source': ('cru', 'era', 'dela', 'spei', 'all'),
+    'variable': ('tmp', 'pre', 'spei'),
+    'weight': ('pop', 'lights', 'un'),
+    'weight_year': ('2000', '2005', '2010', '2015'),
+    'frequency': ('monthly', 'daily'),
+    'format': ('csv', 'json', 'parquet'),
+}
+
+DEFAULTS = {
+    'geo_resolution': 'gadm0',
+    'weight_year': '2015',
+    'frequency': 'monthly',
+    'format': 'csv',
+}
+
+MEDIA_TYPES = {
+    'csv': 'text/csv',
+    'json': 'application/json',
+    'parquet': 'application/vnd.apache.parquet',
+}
+
+
+class _Sink:
+    """
+    Write-only file object collecting the bytes produced by the parquet writer, so that
+    they can be streamed while the writer keeps track of its own offsets
+    """
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def parse_params(query_params):
+    """
+    Validate the parameters of a /data request
+
+    Parameters:
+    query_params (mapping): Query string parameters of the request
+
+    Returns:
+    params (dict): Normalized parameters
+    """
+    params = {}
+    for name, choices in CHOICES.items():
+        value = query_params.get(name, DEFAULTS.get(name))
+        if value not in choices:
+            raise HTTPException(400, f"Parameter '{name}' must be one of: " + ', '.join(choices))
+        params[name] = value
+
+    date_format = '%Y-%m-%d' if params['frequency'] == 'daily' else '%Y-%m'
+    for name in ('start', 'end'):
+        value = query_params.get(name)
+        if value is not None:
+            try:
+                value = datetime.datetime.strptime(value, date_format)
+            except ValueError:
+                raise HTTPException(400, f"Parameter '{name}' must be formatted as " + date_format.replace('%', ''))
+            value = value.strftime('X%Y%m%d' if params['frequency'] == 'daily' else 'X%Y%m')
+        params[name] = value
+
+    reference_period = (query_params.get('reference_start'), query_params.get('reference_end'))
+    if reference_period == (None, None):
+        params['reference_period'] = None
+    elif not all(year is not None and year.isdigit() for year in reference_period):
+        raise HTTPException(400, "Parameters 'reference_start' and 'reference_end' must both be years")
+    else:
+        params['reference_period'] = (int(reference_period[0]), int(reference_period[1]))
+        if params['reference_period'][0] > params['reference_period'][1]:
+            raise HTTPException(400, "Parameter 'reference_start' must not be after 'reference_end'")
+        window = retrieval.load_catalog()['sources'].get(params['source'], {}).get(params['frequency'])
+        if window is not None and (params['reference_period'][1] < int(window['start'][:4])
+                                   or params['reference_period'][0] > int(window['end'][:4])):
+            raise HTTPException(400, f"Reference period outside the coverage of the source ({window['start'][:4]}-{window['end'][:4]})")
+
+    units = query_params.get('units')
+    bbox = query_params.get('bbox')
+    if bbox is not None:
+        if units is not None:
+            raise HTTPException(400, "Parameters 'units' and 'bbox' are mutually exclusive")
+        try:
+            west, south, east, north = [float(value) for value in bbox.split(',')]
+        except ValueError:
+            raise HTTPException(400, "Parameter 'bbox' must be formatted as west,south,east,north")
+        try:
+            params['units'] = tuple(spatial_index.bbox('gadm0', west, south, east, north))
+        except ValueError as error:
+            raise HTTPException(400, f"Parameter 'bbox' is not valid: {error}")
+        if params['units'] == ():
+            raise HTTPException(400, 'No unit intersects the bounding box')
+    elif units is None or units == '*':
+        params['units'] = '*'
+    else:
+        params['units'] = tuple(sorted(set(unit.strip().upper() for unit in units.split(',') if unit.strip() != '')))
+
+    if params['source'] == 'all' and (params['frequency'] != 'monthly' or params['reference_period'] is not None):
+        raise HTTPException(400, "Source comparison is only available for monthly data without anomalies")
+
+    for name in ('bins', 'degree_days'):
+        value = query_params.get(name)
+        try:
+            params[name] = None if value is None else tuple(float(number) for number in value.split(',') if number.strip() != '')
+        except ValueError:
+            raise HTTPException(400, f"Parameter '{name}' must be comma separated numbers")
+    if params['bins'] is not None:
+        if len(params['bins']) == 0 or any(upper <= lower for lower, upper in zip(params['bins'][:-1], params['bins'][1:])):
+            raise HTTPException(400, "Parameter 'bins' must be increasing")
+        if params['frequency'] != 'daily' or params['source'] == 'all' or params['reference_period'] is not None:
+            raise HTTPException(400, "Histograms are only available for daily data of a single source without anomalies")
+        if params['degree_days'] is not None and len(set(params['degree_days'])) != len(params['degree_days']):
+            raise HTTPException(400, "Parameter 'degree_days' must not repeat a base")
+    elif params['degree_days'] is not None:
+        raise HTTPException(400, "Parameter 'degree_days' requires 'bins'")
+    return params
+
+
+def query_files(params):
+    """
+    Return the data files read by a query, raising 404 if any of them is not available and
+    503 if any of them is not readable on this server (such as a Git LFS pointer)
+    """
+    if params['source'] == 'all':
+        sources = retrieval.COMPARISON_SOURCES
+    else:
+        sources = (params['source'],)
+    files = [retrieval.data_file(params['geo_resolution'], source, params['variable'], params['weight'],
+                                 params['weight_year'], params['frequency']) for source in sources]
+    for file in files:
+        if not os.path.isfile(file):
+            raise HTTPException(404, 'Data not available: ' + os.path.basename(file))
+        for part in retrieval.dataset_files(file):
+            try:
+                pq.read_schema(part)
+            except pa.ArrowInvalid:
+                raise HTTPException(503, 'Data not readable on this server: ' + os.path.basename(part))
+    return files
+
+
+def compute_etag(params, files):
+    """
+    Strong ETag of a response: it changes if and only if the underlying files or the query change
+    """
+    digest = hashlib.sha256()
+    for file in files:
+        for part in retrieval.dataset_files(file):
+            digest.update(hot_store.file_hash(part).encode())
+    digest.update(json.dumps(params, sort_keys=True).encode())
+    return '"' + digest.hexdigest() + '"'
+
+
+def stream_data(params, files):
+    """
+    Run the query and yield the encoded response one record batch at a time
+    """
+    conditions = []
+    if params['start'] is not None:
+        conditions.append(f"Date >= '{params['start']}'")
+    if params['end'] is not None:
+        conditions.append(f"Date <= '{params['end']}'")
+    where = ' AND '.join(conditions) if conditions else 'TRUE'
+
+    units = retrieval.select_units(params['geo_resolution'], params['units'])
+    if units != '*':
+        missing = set(units) - set(retrieval.file_units(files[0]))
+        if missing:
+            raise HTTPException(400, 'Unknown units: ' + ', '.join(sorted(missing)))
+
+    con = db.connect()
+    try:
+        if params['bins'] is not None:
+            years = tuple(int(label[1:5]) if label is not None else default
+                          for label, default in ((params['start'], 0), (params['end'], 9999)))
+            result = retrieval.query_histogram(con, files[0], units, years, params['bins'], params['degree_days'] or ())
+        elif params['source'] == 'all':
+            result = retrieval.query_comparison(con, params['geo_resolution'], params['variable'], params['weight'],
+                                                params['weight_year'], units, where)
+        else:
+            result = retrieval.query_data(con, files[0], params['frequency'], units, where, params['reference_period'])
+        reader = result.to_arrow_reader(BATCH_SIZE)
+
+        if params['format'] == 'parquet':
+            sink = _Sink()
+            writer = pq.ParquetWriter(sink, reader.schema)
+            for batch in reader:
+                writer.write_batch(batch)
+                yield sink.drain()
+            writer.close()
+            yield sink.drain()
+        elif params['format'] == 'csv':
+            header = True
+            for batch in reader:
+                buffer = io.BytesIO()
+                pa_csv.write_csv(batch, buffer, write_options=pa_csv.WriteOptions(include_header=header))
+                header = False
+                yield buffer.getvalue()
+        else:
+            separator = b'['
+            for batch in reader:
+                records = batch.to_pandas().to_json(orient='records')[1:-1]
+                if records:
+                    yield separator + records.encode()
+                    separator = b','
+            yield b'[]' if separator == b'[' else b']'
+    finally:
+        con.close()
+
+
+async def data(request):
+    # The spatial index, the file schemas and the hashes may read files: keep them off the event loop
+    params = await run_in_threadpool(parse_params, request.query_params)
+    files = await run_in_threadpool(query_files, params)
+    etag = await run_in_threadpool(compute_etag, params, files)
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+
+    # If-None-Match uses the weak comparison (RFC 7232, section 3.2): W/ prefixes are ignored
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+        if '*' in tags or etag in tags:
+            return Response(status_code=304, headers=headers)
+
+    # Fail before streaming if the query is invalid
+    chunks = stream_data(params, files)
+    first = await run_in_threadpool(next, chunks, b'')
+
+    def body():
+        yield first
+        yield from chunks
+
+    filename = '_'.join([params['geo_resolution'], params['source'], params['variable'], params['weight'],
+                         'histogram' if params['bins'] is not None else params['frequency']])
+    headers['Content-Disposition'] = f'attachment; filename="{filename}.{params["format"]}"'
+    return StreamingResponse(body(), media_type=MEDIA_TYPES[params['format']], headers=headers)
+
+
+async def datasets(request):
+    def describe():
+        return [{'file': os.path.basename(file), 'size': os.path.getsize(file), 'sha256': hot_store.file_hash(file)}
+                for file in sorted(glob.glob('./data/**/*.parquet', recursive=True))]
+    return JSONResponse(await run_in_threadpool(describe))
+
+
+app = Starlette(routes=[
+    Route('/data', data),
+    Route('/datasets', datasets),
+])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve the repository data over HTTP')
+    parser.add_argument('--host', default='127.0.0.1', help='Interface to bind')
+    parser.add_argument('--port', type=int, default=8000, help='Port to listen on')
+    args = parser.parse_args()
+    uvicorn.run(app, host=args.host, port=args.port)
@@ -0,0 +1,303 @@
+"""
+Hot store of data files and geometries as uncompressed Arrow IPC files
+
+Every process memory-maps the IPC files read-only, so the tables are zero-copy views on
+the shared page cache instead of private copies in each Streamlit worker. Files are named
+after the SHA-256 of their source, so a source that changes gets a new entry and the stale
+one is dropped (refresh), and the least recently used entries are removed once the store
+exceeds MAX_BYTES (eviction). Removing a file does not affect processes that still map it.
+Eviction is serialized across processes and best effort: entries removed concurrently by
+another process are skipped, and a failed eviction never fails the read that triggered it.
+
+Run from the root of the repository:
+
+    python -m script.hot_store warm
+    python -m script.hot_store benchmark --workers 4
+"""
+
+import argparse
+import contextlib
+import fcntl
+import functools
+import glob
+import hashlib
+import multiprocessing
+import os
+import tempfile
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+STORE_PATH = './hot_store'
+MAX_BYTES = 4 * 1024 ** 3
+
+
+@functools.lru_cache(maxsize=None)
+def _file_hash(file, mtime_ns, size):
+    digest = hashlib.sha256()
+    with open(file, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def file_hash(file):
+    """
+    Return the SHA-256 of a data file. Hashes are cached on the modification time and
+    size of the file, so a file is read again only after it changes
+    """
+    stat = os.stat(file)
+    return _file_hash(file, stat.st_mtime_ns, stat.st_size)
+
+
+def _entry(name, sources):
+    digest = hashlib.sha256()
+    for source in sources:
+        digest.update(file_hash(source).encode())
+    return os.path.join(STORE_PATH, name + '-' + digest.hexdigest()[:16] + '.arrow')
+
+
+def _write(path, table):
+    os.makedirs(STORE_PATH, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=STORE_PATH, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        with pa.ipc.new_file(f, table.schema) as writer:
+            writer.write_table(table)
+    os.chmod(tmp, 0o644)
+    os.replace(tmp, path)
+
+
+@contextlib.contextmanager
+def _store_lock():
+    """
+    Serialize cleanups of the store across processes
+    """
+    os.makedirs(STORE_PATH, exist_ok=True)
+    with open(os.path.join(STORE_PATH, '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def drop(name, keep=None):
+    """
+    Remove the entries of a dataset from the store, except the one at path keep
+    """
+    with _store_lock():
+        for path in glob.glob(os.path.join(STORE_PATH, name + '-*.arrow')):
+            if path != keep and os.path.basename(path).rsplit('-', 1)[0] == name:
+                _remove(path)
+
+
+def _evict(keep):
+    """
+    Drop stale versions of the entry being used and the least recently used entries
+    beyond MAX_BYTES
+    """
+    drop(os.path.basename(keep).rsplit('-', 1)[0], keep)
+    with _store_lock():
+        entries = []
+        for path in glob.glob(os.path.join(STORE_PATH, '*.arrow')):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if path != keep:
+                entries.append((stat.st_atime, stat.st_size, path))
+        entries.sort(reverse=True)
+        total = os.path.getsize(keep)
+        for _, size, path in entries:
+            total += size
+            if total > MAX_BYTES:
+                _remove(path)
+
+
+def _map(path):
+    return pa.ipc.open_file(pa.memory_map(path, 'r')).read_all()
+
+
+def _open(name, sources, build):
+    path = _entry(name, sources)
+    try:
+        os.utime(path)
+        return _map(path)
+    except FileNotFoundError:
+        pass
+
+    table = build()
+    _write(path, table)
+    try:
+        _evict(path)
+    except OSError:
+        pass
+    try:
+        return _map(path)
+    except FileNotFoundError:
+        # Removed by another process in the meantime: serve the table just built
+        return table
+
+
+def dataset(files):
+    """
+    Return a dataset as a memory-mapped Arrow table, adding it to the store if needed
+
+    Parameters:
+    files (str or list): Path of the parquet file, or paths of the data file followed by
+    its appended partitions
+
+    Returns:
+    table (pyarrow table): Zero-copy table backed by the hot store
+    """
+    if isinstance(files, str):
+        files = [files]
+    name = os.path.splitext(os.path.basename(files[0]))[0]
+    return _open(name, files, lambda: pa.concat_tables([pq.read_table(file) for file in files]))
+
+
+def derived(name, sources, build, key=None):
+    """
+    Return a table computed from source files as a memory-mapped Arrow table, building it
+    and adding it to the store if needed
+
+    Parameters:
+    name (str): Name of the entry, distinct from the names of the datasets
+    sources (list): Paths of the files the table is computed from
+    build (function): Function without arguments returning the table
+    key (tuple): Arguments the table depends on besides the sources, such as those of a
+    query, stored as separate entries
+
+    Returns:
+    table (pyarrow table): Zero-copy table backed by the hot store
+    """
+    if key is not None:
+        name += '_' + hashlib.sha256(repr(key).encode()).hexdigest()[:16]
+    return _open(name, sources, build)
+
+
+def geometries_source(geo_resolution):
+    """
+    Return the file the shapes of a geographical resolution are read from: the pickled
+    geopandas dataframe if available, the geopackage otherwise
+    """
+    source = './poly/' + geo_resolution + '.pickle'
+    if not os.path.exists(source):
+        source = './poly/' + geo_resolution + '.gpkg'
+    return source
+
+
+def _read_shapes(source):
+    import geopandas as gpd
+    import pickle
+
+    if source.endswith('.pickle'):
+        with open(source, 'rb') as picklefile:
+            return pickle.load(picklefile)
+    return gpd.read_file(source).rename(columns={'iso3': 'GID_0'})
+
+
+def geometries(geo_resolution):
+    """
+    Return the shapes of a geographical resolution as a memory-mapped Arrow table, with
+    geometries encoded as WKB, adding them to the store if needed
+
+    Parameters:
+    geo_resolution (str): Geographical resolution of the shapes
+
+    Returns:
+    table (pyarrow table): Zero-copy table backed by the hot store
+    """
+    source = geometries_source(geo_resolution)
+    return _open(geo_resolution + '_shapes', [source],
+                 lambda: pa.Table.from_pandas(_read_shapes(source).to_wkb(), preserve_index=False))
+
+
+def warm():
+    """
+    Add every data file of the repository to the store
+    """
+    from script import retrieval
+
+    for file in sorted(glob.glob('./data/*.parquet')):
+        try:
+            dataset(retrieval.dataset_files(file))
+        except (pa.ArrowInvalid, OSError) as error:
+            print('Skipping', file, '-', error)
+        else:
+            print('Stored', file)
+
+
+def _rss_worker(files, shapes, use_store, results):
+    import pandas as pd
+    from script import spatial_index
+
+    if use_store:
+        tables = [dataset(file) for file in files]
+        checksum = sum(float(pc.sum(table.column(1)).as_py() or 0) for table in tables)
+        # The geometries of the spatial index, also plotted by the pages
+        decoded = [spatial_index.geometries(geo_resolution) for geo_resolution in shapes]
+    else:
+        frames = [pd.read_parquet(file) for file in files]
+        checksum = sum(float(frame.iloc[:, 1].sum()) for frame in frames)
+        # A private geopandas dataframe, as st.cache_resource kept, besides the spatial index
+        decoded = [(_read_shapes(geometries_source(geo_resolution)), spatial_index.geometries(geo_resolution))
+                   for geo_resolution in shapes]
+
+    memory = {}
+    with open('/proc/self/smaps_rollup') as smaps:
+        for line in smaps:
+            fields = line.split()
+            if fields[0] in ('Rss:', 'Pss:', 'Private_Clean:', 'Private_Dirty:'):
+                memory[fields[0][:-1]] = int(fields[1]) / 1024
+    memory['checksum'] = checksum
+    memory['shapes'] = len(decoded)
+    results.put(memory)
+
+
+def benchmark(workers, files, shapes=()):
+    """
+    Compare the memory of worker processes holding the same data files as private pandas
+    frames (as st.cache_data does) or as memory-mapped hot store tables, and the same shapes
+    as private geopandas dataframes next to the spatial index or as the geometries of the
+    index only. Linux only
+    """
+    for file in files:
+        dataset(file)
+    for geo_resolution in shapes:
+        geometries(geo_resolution)
+    for use_store in (False, True):
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=_rss_worker, args=(files, shapes, use_store, results)) for _ in range(workers)]
+        for process in processes:
+            process.start()
+        memory = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+        label = 'hot store' if use_store else 'pandas'
+        mean = {key: sum(m[key] for m in memory) / workers for key in ('Rss', 'Pss', 'Private_Dirty')}
+        print(f"{label:>9}: {workers} workers, {len(files)} files, {len(shapes)} shapes, per process RSS {mean['Rss']:.0f} MB, "
+              f"PSS {mean['Pss']:.0f} MB, private dirty {mean['Private_Dirty']:.0f} MB")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Manage the hot store of memory-mapped Arrow files')
+    parser.add_argument('command', choices=('warm', 'benchmark'))
+    parser.add_argument('--workers', type=int, default=4, help='Number of worker processes of the benchmark')
+    parser.add_argument('--files', nargs='*', default=sorted(glob.glob('./data/gadm0_*_monthly.parquet')),
+                        help='Data files loaded by each worker of the benchmark')
+    parser.add_argument('--shapes', nargs='*', default=['gadm0'],
+                        help='Geographical resolutions of the shapes loaded by each worker of the benchmark')
+    args = parser.parse_args()
+    if args.command == 'warm':
+        warm()
+    else:
+        benchmark(args.workers, args.files, args.shapes)
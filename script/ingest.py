@@ -0,0 +1,176 @@
+"""
+Incremental ingestion of new periods into the data files
+
+New data comes as parquet files named like the data file they extend (for instance
+gadm0_cru_tmp_pop_2015_monthly.parquet) and holding only the new dates, with the same Date
+labels and unit columns. The new dates must directly follow the end of the data file, without
+gaps or duplicates. Run from the root of the repository:
+
+    python -m script.ingest append incoming/*.parquet
+    python -m script.ingest status
+
+Every new file is written as a partition under ./data/partitions/<data file name>/ and the
+data files themselves are never rewritten. The catalog (./data/catalog.json) is then updated
+atomically: the partition is listed with the last date it covers, and the coverage end of a
+source moves forward once every data file of that source and frequency has been extended.
+Cached entries of the extended data files only are dropped from the hot store; other caches
+are keyed on the files they read, so they pick up the new partitions by themselves.
+"""
+
+import argparse
+import contextlib
+import copy
+import fcntl
+import glob
+import json
+import os
+import tempfile
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from script import hot_store, retrieval
+
+PARTITIONS_PATH = './data/partitions'
+
+
+@contextlib.contextmanager
+def catalog_lock():
+    """
+    Serialize updates of the catalog across processes
+    """
+    with open(retrieval.CATALOG_PATH + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def write_catalog(catalog):
+    """
+    Replace the catalog atomically, so readers see either the old or the new version
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(retrieval.CATALOG_PATH), suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(catalog, f, indent=4)
+        f.write('\n')
+    os.chmod(tmp, 0o644)
+    os.replace(tmp, retrieval.CATALOG_PATH)
+
+
+def label_date(label, freq):
+    """
+    Return the last day covered by a label of the Date column, as YYYY-MM-DD
+    """
+    if freq == 'daily':
+        return label[1:5] + '-' + label[5:7] + '-' + label[7:9]
+    return pd.Period(label[1:5] + '-' + label[5:7], freq='M').end_time.strftime('%Y-%m-%d')
+
+
+def split_name(name):
+    """
+    Return the source and the frequency of a data file from its name
+    """
+    fields = name.split('_')
+    return fields[1], fields[-1]
+
+
+def dataset_end(catalog, name):
+    source, freq = split_name(name)
+    return catalog['partitions'].get(name, {}).get('end', catalog['sources'][source][freq]['end'])
+
+
+def expected_labels(end, freq, n):
+    """
+    Return the n labels of the Date column directly following the last date covered
+    """
+    if freq == 'daily':
+        return pd.date_range(pd.Timestamp(end) + pd.Timedelta(days=1), periods=n, freq='D').strftime('X%Y%m%d').tolist()
+    return pd.period_range(pd.Period(end[:7], freq='M') + 1, periods=n, freq='M').strftime('X%Y%m').tolist()
+
+
+def append(path):
+    """
+    Append the dates of a parquet file to the data file with the same name
+
+    Parameters:
+    path (str): Path of the parquet file with the new dates
+
+    Returns:
+    name (str): Name of the extended data file
+    """
+    name = os.path.splitext(os.path.basename(path))[0]
+    file = './data/' + name + '.parquet'
+    if not os.path.isfile(file):
+        raise ValueError(f'{path}: no data file named {name}.parquet')
+    source, freq = split_name(name)
+
+    schema = pq.read_schema(file)
+    table = pq.read_table(path)
+    unknown = set(table.column_names) - set(schema.names)
+    if 'Date' not in table.column_names or unknown:
+        raise ValueError(f'{path}: Date column missing or unknown columns ' + ', '.join(sorted(unknown)))
+    columns = [table.column(field.name) if field.name in table.column_names else pa.nulls(table.num_rows, field.type)
+               for field in schema]
+    table = pa.Table.from_arrays(columns, schema=schema).sort_by('Date')
+    dates = table.column('Date')
+
+    label_length = 9 if freq == 'daily' else 7
+    if not pc.all(pc.equal(pc.utf8_length(dates), label_length)).as_py():
+        raise ValueError(f'{path}: Date labels do not match the {freq} format')
+
+    with catalog_lock():
+        catalog = retrieval.load_catalog()
+        first, last = dates[0].as_py(), dates[-1].as_py()
+        expected = expected_labels(dataset_end(catalog, name), freq, table.num_rows)
+        if dates.to_pylist() != expected:
+            raise ValueError(f'{path}: dates must be unique and contiguous, starting from {expected[0]} '
+                             f'right after the end of {name}')
+
+        part = os.path.join(PARTITIONS_PATH, name, first + '_' + last + '.parquet')
+        os.makedirs(os.path.dirname(part), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(part), suffix='.tmp')
+        os.close(fd)
+        pq.write_table(table, tmp)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, part)
+
+        catalog = copy.deepcopy(catalog)
+        entry = catalog['partitions'].setdefault(name, {'parts': []})
+        entry['parts'].append(part)
+        entry['end'] = label_date(last, freq)
+        names = [os.path.splitext(os.path.basename(other))[0] for other in glob.glob(f'./data/*_{source}_*_{freq}.parquet')]
+        catalog['sources'][source][freq]['end'] = min(dataset_end(catalog, other) for other in names)
+        write_catalog(catalog)
+
+    hot_store.drop(name)
+    return name
+
+
+def status():
+    """
+    Print the coverage of every source and the partitions appended to the data files
+    """
+    catalog = retrieval.load_catalog()
+    for source, frequencies in catalog['sources'].items():
+        for freq, window in frequencies.items():
+            print(f"{source:>5} {freq:>8}: {window['start']} to {window['end']}")
+    for name, entry in sorted(catalog['partitions'].items()):
+        print(f"{name}: {len(entry['parts'])} partitions, up to {entry['end']}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Append new periods to the data files')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    append_parser = subparsers.add_parser('append', help='Append parquet files with new dates')
+    append_parser.add_argument('paths', nargs='+', help='Parquet files named like the data files they extend')
+    subparsers.add_parser('status', help='Show the coverage of the sources')
+    args = parser.parse_args()
+
+    if args.command == 'append':
+        for path in args.paths:
+            print('Appended', path, 'to', append(path))
+    status()
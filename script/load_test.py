@@ -0,0 +1,105 @@
+"""
+Concurrency load test of the HTTP API (script/api.py)
+
+Start the API, then run from the root of the repository:
+
+    python -m script.load_test --url http://127.0.0.1:8000 --requests 200 --concurrency 20
+
+Each client fetches a mix of queries, then revalidates them with If-None-Match. The test
+reports throughput and latency percentiles, and fails if any request errors or if any
+revalidation does not return 304 Not Modified.
+"""
+
+import argparse
+import asyncio
+import time
+import urllib.parse
+
+import numpy as np
+
+QUERIES = [
+    {'source': 'cru', 'variable': 'tmp', 'weight': 'pop', 'units': 'USA,ITA,FRA', 'start': '1990-01', 'end': '2020-12', 'format': 'csv'},
+    {'source': 'era', 'variable': 'pre', 'weight': 'lights', 'weight_year': '2010', 'format': 'parquet'},
+    {'source': 'dela', 'variable': 'tmp', 'weight': 'un', 'units': 'BRA', 'format': 'json'},
+    {'source': 'cru', 'variable': 'tmp', 'weight': 'pop', 'reference_start': '1961', 'reference_end': '1990', 'format': 'csv'},
+    {'source': 'all', 'variable': 'pre', 'weight': 'pop', 'units': 'IND', 'start': '1950-01', 'end': '2017-12', 'format': 'json'},
+]
+
+
+async def fetch(url, headers=None):
+    """
+    Minimal HTTP/1.1 GET, returning the status, the headers and the size of the body
+    """
+    parts = urllib.parse.urlsplit(url)
+    reader, writer = await asyncio.open_connection(parts.hostname, parts.port or 80)
+    request = f'GET {parts.path}?{parts.query} HTTP/1.1\r\nHost: {parts.netloc}\r\nConnection: close\r\n'
+    for name, value in (headers or {}).items():
+        request += f'{name}: {value}\r\n'
+    writer.write((request + '\r\n').encode())
+    await writer.drain()
+
+    status = int((await reader.readline()).split()[1])
+    response_headers = {}
+    while True:
+        line = (await reader.readline()).decode().strip()
+        if line == '':
+            break
+        name, value = line.split(':', 1)
+        response_headers[name.lower()] = value.strip()
+    size = len(await reader.read())
+    writer.close()
+    await writer.wait_closed()
+    return status, response_headers, size
+
+
+async def client(url, queue, latencies, failures):
+    while True:
+        try:
+            i = queue.get_nowait()
+        except asyncio.QueueEmpty:
+            return
+        query_url = url + '/data?' + urllib.parse.urlencode(QUERIES[i % len(QUERIES)])
+        start = time.perf_counter()
+        status, headers, size = await fetch(query_url)
+        latencies['full'].append(time.perf_counter() - start)
+        if status != 200 or size == 0:
+            failures.append(f'{query_url}: status {status}')
+            continue
+
+        start = time.perf_counter()
+        status, _, _ = await fetch(query_url, {'If-None-Match': headers['etag']})
+        latencies['revalidation'].append(time.perf_counter() - start)
+        if status != 304:
+            failures.append(f'{query_url}: revalidation status {status}')
+
+
+async def main(url, n_requests, concurrency):
+    queue = asyncio.Queue()
+    for i in range(n_requests):
+        queue.put_nowait(i)
+    latencies = {'full': [], 'revalidation': []}
+    failures = []
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client(url, queue, latencies, failures) for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+
+    print(f'{n_requests} queries with {concurrency} concurrent clients in {elapsed:.2f} s '
+          f'({2 * n_requests / elapsed:.1f} requests/s)')
+    for kind, values in latencies.items():
+        if values:
+            p50, p95, p99 = np.percentile(values, [50, 95, 99]) * 1000
+            print(f'{kind:>12}: p50 {p50:.1f} ms, p95 {p95:.1f} ms, p99 {p99:.1f} ms')
+    for failure in failures:
+        print('FAILED', failure)
+    return len(failures) == 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Concurrency load test of the HTTP API')
+    parser.add_argument('--url', default='http://127.0.0.1:8000', help='Base URL of the API')
+    parser.add_argument('--requests', type=int, default=200, help='Number of queries')
+    parser.add_argument('--concurrency', type=int, default=20, help='Number of concurrent clients')
+    args = parser.parse_args()
+    ok = asyncio.run(main(args.url.rstrip('/'), args.requests, args.concurrency))
+    raise SystemExit(0 if ok else 1)
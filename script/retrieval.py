@@ -0,0 +1,428 @@
+"""
+Data layer shared by the dashboard pages and the HTTP API (script/api.py)
+
+Data files are wide parquet tables with a Date column of labels ('X195101' for monthly
+data, 'X19510101' for daily data) and one column per geographical unit. Queries scan the
+memory-mapped copies of the files in the hot store (script/hot_store.py). Paths are relative
+to the root of the repository, which is expected to be the working directory.
+"""
+
+import functools
+import json
+import os
+
+import duckdb as db
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from script import hot_store
+
+# Sources sharing temperature and precipitation, used by the comparison mode
+COMPARISON_SOURCES = ('cru', 'era', 'dela')
+
+# Coverage of every source and partitions appended to the data files (script/ingest.py)
+CATALOG_PATH = './data/catalog.json'
+
+
+@functools.lru_cache(maxsize=4)
+def _load_catalog(mtime_ns):
+    with open(CATALOG_PATH) as f:
+        return json.load(f)
+
+
+def load_catalog():
+    """
+    Return the dataset catalog, read again only after it changes. The catalog holds the
+    first and last date covered by every source and frequency ('sources') and the partitions
+    appended to every data file, with the last date they cover ('partitions')
+    """
+    return _load_catalog(os.stat(CATALOG_PATH).st_mtime_ns)
+
+
+def coverage(sources, freq):
+    """
+    Return the window of dates covered by all the given sources
+
+    Parameters:
+    sources (str or tuple): Name of the source in the file names, or several of them
+    freq (str): Frequency of the data, either 'monthly' or 'daily'
+
+    Returns:
+    start (str): First date covered, as YYYY-MM-DD
+    end (str): Last date covered, as YYYY-MM-DD
+    """
+    if isinstance(sources, str):
+        sources = (sources,)
+    windows = [load_catalog()['sources'][source][freq] for source in sources]
+    return max(window['start'] for window in windows), min(window['end'] for window in windows)
+
+
+def date_label(date, freq):
+    """
+    Return the label of a YYYY-MM-DD date in the Date column of the data files
+    """
+    if freq == 'daily':
+        return 'X' + date[:4] + date[5:7] + date[8:10]
+    return 'X' + date[:4] + date[5:7]
+
+
+def dataset_files(file):
+    """
+    Return the parquet files making up a dataset: the data file followed by the partitions
+    appended to it, in chronological order
+    """
+    name = os.path.splitext(os.path.basename(file))[0]
+    return [file] + load_catalog()['partitions'].get(name, {}).get('parts', [])
+
+
+def data_file(geo_resolution, source, variable, weight, weight_year, freq):
+    """
+    Return the path of the parquet file of a data specification
+
+    Parameters:
+    geo_resolution (str): Geographical resolution of the data ('gadm0' or 'gadm1')
+    source (str): Name of the climate source in the file names ('cru', 'era', 'dela', 'spei')
+    variable (str): Name of the climate variable in the file names ('tmp', 'pre', 'spei')
+    weight (str): Name of the weighting variable in the file names ('pop', 'lights', 'un')
+    weight_year (str): Base year of the weighting variable, ignored for unweighted data
+    freq (str): Frequency of the data file, either 'monthly' or 'daily'
+
+    Returns:
+    file (str): Path of the parquet file
+    """
+    if weight == 'un':
+        weight_year = ''
+    return './data/' + geo_resolution + '_' + source + '_' + variable + '_' + weight + '_' + weight_year + '_' + freq + '.parquet'
+
+
+def select_units(geo_resolution, col_range):
+    """
+    Translate a selection of countries into the columns of a data file
+
+    Parameters:
+    geo_resolution (str): Geographical resolution of the data
+    col_range (tuple or str): Selected GID_0 codes, which select all the regions of a country
+    at gadm1, or GID_1 codes, or '*' for all units
+
+    Returns:
+    units (list or str): Column names of the selected units, or '*' for all units
+    """
+    if col_range == '*':
+        return '*'
+    if geo_resolution == 'gadm0':
+        return list(col_range)
+    regions = pd.read_csv('./poly/gadm1_adm.csv')
+    units = regions.loc[regions.GID_0.isin(col_range) | regions.GID_1.isin(col_range), 'GID_1']
+    return [str(unit).replace('.', '_') for unit in units]
+
+
+def file_units(file):
+    """
+    Return the unit columns of a data file, read from the parquet metadata only
+    """
+    return [col for col in pq.read_schema(file).names if col != 'Date']
+
+
+def period_expression(freq, date_col='Date'):
+    """
+    DuckDB expression extracting the calendar period of a date label: the month for
+    monthly data ('X195101') and the month and day for daily data ('X19510101'), numbered
+    as the days of a leap year, so that February 29 is period 60 and March 1 is always 61
+
+    Parameters:
+    freq (str): Frequency of the data file, either 'monthly' or 'daily'
+    date_col (str): Name of the date column
+
+    Returns:
+    expression (str): SQL expression returning an integer period
+    """
+    if freq == 'daily':
+        return (f"dayofyear(make_date(2000, CAST(substr({date_col}, 6, 2) AS INTEGER), "
+                f"CAST(substr({date_col}, 8, 2) AS INTEGER)))")
+    return f"CAST(substr({date_col}, 6, 2) AS INTEGER)"
+
+
+def scan(con, file, name='data'):
+    """
+    Register the hot store table of a data file on a DuckDB connection
+
+    Parameters:
+    con (duckdb connection): Connection the table is registered on
+    file (str): Path of the parquet file
+    name (str): Name of the table in the queries
+
+    Returns:
+    name (str): Name of the table in the queries
+    """
+    con.register(name, hot_store.dataset(dataset_files(file)))
+    return name
+
+
+def _partial_sums(files, freq):
+    units = file_units(files[0])
+    aggregates = ', '.join([f'SUM("{unit}"), COUNT("{unit}")' for unit in units])
+    query = f"""SELECT CAST(substr(Date, 2, 4) AS INTEGER) AS year, {period_expression(freq)} AS period, {aggregates}
+                FROM data GROUP BY ALL ORDER BY year, period"""
+    with db.connect() as con:
+        con.register('data', hot_store.dataset(list(files)))
+        partial = con.execute(query).fetchnumpy()
+
+    years = partial['year'] - partial['year'].min()
+    periods = partial['period'] - 1
+    n_periods = 366 if freq == 'daily' else 12
+    values = np.stack([np.asarray(col, dtype=float) for col in list(partial.values())[2:]], axis=1)
+    values = np.nan_to_num(values)
+
+    shape = (int(years.max()) + 1, n_periods, len(units))
+    sums = np.zeros(shape, dtype=np.float32)
+    counts = np.zeros(shape, dtype=np.int16)
+    sums[years, periods] = values[:, 0::2]
+    counts[years, periods] = values[:, 1::2]
+    metadata = {'first_year': str(partial['year'].min()), 'shape': json.dumps(shape), 'units': json.dumps(units)}
+    return pa.table({'sum': sums.ravel(), 'count': counts.ravel()}).replace_schema_metadata(metadata)
+
+
+def partial_sums(file, freq):
+    """
+    Scan a data file once and return the sums and counts of every unit by year and calendar
+    period, so that the climatology of any reference window only adds up its years. They are
+    kept in the hot store, shared by all processes, as float32 sums and int16 counts
+
+    Parameters:
+    file (str): Path of the parquet file
+    freq (str): Frequency of the data file, either 'monthly' or 'daily'
+
+    Returns:
+    first_year (int): First year covered by the file
+    sums (numpy array): Sums, shape (n_years, n_periods, n_units)
+    counts (numpy array): Non-missing counts, same shape as sums
+    units (list): Unit names, in the order of the last axis
+    """
+    files = tuple(dataset_files(file))
+    name = os.path.splitext(os.path.basename(file))[0] + '_yearly_sums'
+    table = hot_store.derived(name, files, lambda: _partial_sums(files, freq))
+    metadata = table.schema.metadata
+    shape = tuple(json.loads(metadata[b'shape']))
+    return (int(metadata[b'first_year']), table.column('sum').to_numpy().reshape(shape),
+            table.column('count').to_numpy().reshape(shape), json.loads(metadata[b'units']))
+
+
+def baseline(file, freq, reference_period):
+    """
+    Return the per-unit climatology of a data file over a reference window of years,
+    reusing the stored partial sums of the file
+
+    Parameters:
+    file (str): Path of the parquet file
+    freq (str): Frequency of the data file, either 'monthly' or 'daily'
+    reference_period (tuple): First and last year of the reference window, overlapping the
+    years of the file
+
+    Returns:
+    baseline (pandas dataframe): Mean value by calendar period (rows) and unit (columns)
+    """
+    first_year, sums, counts, units = partial_sums(file, freq)
+    last_year = first_year + sums.shape[0] - 1
+    if reference_period[0] > reference_period[1] or reference_period[1] < first_year or reference_period[0] > last_year:
+        raise ValueError(f'Reference period {reference_period[0]}-{reference_period[1]} must be ordered '
+                         f'and overlap the years of the file ({first_year}-{last_year})')
+    window = slice(max(reference_period[0] - first_year, 0), reference_period[1] - first_year + 1)
+    # Years are added up in float64, so that the float32 sums only round single years
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums[window].sum(axis=0, dtype=float) / counts[window].sum(axis=0, dtype=int)
+    climatology = pd.DataFrame(means, columns=units)
+    climatology.insert(0, 'period', np.arange(1, means.shape[0] + 1))
+    return climatology
+
+
+def histogram_columns(edges, bases):
+    """
+    Return the column names of the histogram of a bin specification: one column per bin
+    (below the first edge, between consecutive edges, above the last edge) and one per
+    degree-day base. Numbers are written in full, so distinct edges and bases never share
+    a name
+    """
+    def label(number):
+        text = repr(float(number))
+        return text[:-2] if text.endswith('.0') else text
+
+    labels = [f'bin_lt_{label(edges[0])}']
+    labels += [f'bin_{label(lower)}_{label(upper)}' for lower, upper in zip(edges[:-1], edges[1:])]
+    labels += [f'bin_ge_{label(edges[-1])}']
+    return labels + [f'dd_{label(base)}' for base in bases]
+
+
+@functools.lru_cache(maxsize=8)
+def _histogram(files, mtimes_ns, edges, bases):
+    table = hot_store.dataset(list(files))
+    units = [col for col in table.column_names if col != 'Date']
+    years = pc.cast(pc.utf8_slice_codeunits(table.column('Date'), 1, 5), pa.int32()).to_numpy()
+    starts = np.flatnonzero(np.r_[True, years[1:] != years[:-1]])
+    ends = np.r_[starts[1:], len(years)]
+    edges_array = np.asarray(edges, dtype=float)
+    bases_array = np.asarray(bases, dtype=float)
+    n_bins = len(edges) + 1
+
+    counts = np.zeros((len(starts), n_bins, len(units)), dtype=np.int32)
+    degree_days = np.zeros((len(starts), len(bases), len(units)))
+    # One year of days at a time, over all units; missing days go to an extra bin, dropped
+    for i, (start, end) in enumerate(zip(starts, ends)):
+        block = table.slice(start, end - start)
+        values = np.column_stack([block.column(unit).to_numpy() for unit in units]).astype(float)
+        bins = np.searchsorted(edges_array, values, side='right')
+        bins[np.isnan(values)] = n_bins
+        cells = bins * len(units) + np.arange(len(units))
+        counts[i] = np.bincount(cells.ravel(), minlength=(n_bins + 1) * len(units)).reshape(n_bins + 1, len(units))[:n_bins]
+        degree_days[i] = np.nansum(np.maximum(values[:, None, :] - bases_array[:, None], 0), axis=0)
+    return years[starts], counts, degree_days, units
+
+
+def histogram(file, edges, bases=()):
+    """
+    Scan a daily data file once and return, for every unit and year, the number of days
+    in every bin and the degree-days over every base. Results are cached per file and bin
+    specification
+
+    Parameters:
+    file (str): Path of the daily parquet file
+    edges (tuple): Increasing bin edges; bins are closed on the left
+    bases (tuple): Distinct degree-day bases, summing the daily excess over the base
+
+    Returns:
+    years (numpy array): Years covered by the file
+    counts (numpy array): Days in bin, shape (n_years, len(edges) + 1, n_units)
+    degree_days (numpy array): Degree-days, shape (n_years, len(bases), n_units)
+    units (list): Unit names, in the order of the last axis
+    """
+    edges, bases = tuple(float(edge) for edge in edges), tuple(float(base) for base in bases)
+    if len(edges) == 0 or any(upper <= lower for lower, upper in zip(edges[:-1], edges[1:])):
+        raise ValueError('Bin edges must be a non-empty increasing sequence')
+    if len(set(bases)) != len(bases):
+        raise ValueError('Degree-day bases must be distinct')
+    files = tuple(dataset_files(file))
+    return _histogram(files, tuple(os.stat(part).st_mtime_ns for part in files), edges, bases)
+
+
+def query_histogram(con, file, units, years, edges, bases=()):
+    """
+    Return the histogram of a daily data file as a compact unit x year table, on a DuckDB
+    connection
+
+    Parameters:
+    con (duckdb connection): Connection the query runs on
+    file (str): Path of the daily parquet file
+    units (list or str): Units to retrieve, or '*' for all units
+    years (tuple): First and last year to retrieve, or None for all years
+    edges (tuple): Increasing bin edges; bins are closed on the left
+    bases (tuple): Degree-day bases
+
+    Returns:
+    result (duckdb connection): Pending result with unit and year columns followed by the
+    days in every bin and the degree-days over every base (see histogram_columns)
+    """
+    all_years, counts, degree_days, all_units = histogram(file, edges, bases)
+    if units == '*':
+        units = all_units
+    positions = [all_units.index(unit) for unit in units]
+    keep = np.ones(len(all_years), dtype=bool) if years is None else (all_years >= years[0]) & (all_years <= years[1])
+
+    # Rows by unit, then year
+    columns = {'unit': np.repeat(units, keep.sum()), 'year': np.tile(all_years[keep], len(units))}
+    values = [counts[keep][:, :, positions], degree_days[keep][:, :, positions]]
+    labels = iter(histogram_columns(edges, bases))
+    for array in values:
+        for k in range(array.shape[1]):
+            columns[next(labels)] = array[:, k, :].T.ravel()
+    con.register('histogram', pd.DataFrame(columns))
+    return con.execute("SELECT * FROM histogram")
+
+
+def query_data(con, file, freq, units, where, reference_period=None):
+    """
+    Run the query of a data file on a DuckDB connection
+
+    Parameters:
+    con (duckdb connection): Connection the query runs on
+    file (str): Path of the parquet file
+    freq (str): Frequency of the data file, either 'monthly' or 'daily'
+    units (list or str): Columns to retrieve, or '*' for all units
+    where (str): SQL condition on the Date column
+    reference_period (tuple): If given, the climatology of this window of years is
+    subtracted from the data inside the query
+
+    Returns:
+    result (duckdb connection): Pending result with the Date column followed by the units
+    """
+    if reference_period is None:
+        cols = '*' if units == '*' else ', '.join(['Date'] + [f'"{unit}"' for unit in units])
+        return con.execute(f"SELECT {cols} FROM {scan(con, file)} WHERE {where}")
+
+    climatology = baseline(file, freq, reference_period)
+    if units == '*':
+        units = [col for col in climatology.columns if col != 'period']
+    anomalies = ', '.join(['d.Date'] + [f'd."{unit}" - b."{unit}" AS "{unit}"' for unit in units])
+    con.register('baseline', climatology)
+    return con.execute(f"""SELECT {anomalies} FROM {scan(con, file)} d JOIN baseline b ON {period_expression(freq, 'd.Date')} = b.period
+                           WHERE {where} ORDER BY d.Date""")
+
+
+def query_comparison(con, geo_resolution, variable, weight, weight_year, units, where):
+    """
+    Run a single query over the monthly files of CRU TS, ERA5 and UDelaware, returning the
+    series of every source together with their ensemble mean and spread
+
+    Parameters:
+    con (duckdb connection): Connection the query runs on
+    geo_resolution (str): Geographical resolution of the data
+    variable (str): Name of the climate variable in the file names
+    weight (str): Name of the weighting variable in the file names
+    weight_year (str): Base year of the weighting variable
+    units (list or str): Columns to retrieve, or '*' for all units
+    where (str): SQL condition on the Date column, restricted to the dates covered by all sources
+
+    Returns:
+    result (duckdb connection): Pending result with the Date column followed by one column
+    per unit and series, named as unit_cru, unit_era, unit_dela, unit_mean and unit_spread
+    """
+    cols = '*' if units == '*' else ', '.join(['Date'] + [f'"{unit}"' for unit in units])
+    files = [data_file(geo_resolution, source, variable, weight, weight_year, 'monthly') for source in COMPARISON_SOURCES]
+    tables = [scan(con, file, 'data_' + source) for source, file in zip(COMPARISON_SOURCES, files)]
+    common = ' INTERSECT '.join([f"SELECT Date FROM {table}" for table in tables])
+    selects = [f"SELECT '{source}' AS source, {cols} FROM {table} WHERE {where} AND Date IN (SELECT Date FROM common)"
+               for source, table in zip(COMPARISON_SOURCES, tables)]
+
+    query = f"""WITH common AS ({common}),
+                panel AS (
+                    UNPIVOT ({' UNION ALL BY NAME '.join(selects)})
+                    ON COLUMNS(* EXCLUDE (source, Date)) INTO NAME unit VALUE value),
+                ensemble AS (
+                    SELECT Date, unit, source, value FROM panel
+                    UNION ALL
+                    SELECT Date, unit, 'mean' AS source, avg(value) AS value FROM panel GROUP BY Date, unit
+                    UNION ALL
+                    SELECT Date, unit, 'spread' AS source, stddev_samp(value) AS value FROM panel GROUP BY Date, unit),
+                series AS (
+                    SELECT Date, unit || '_' || source AS series, value FROM ensemble)
+                PIVOT series ON series USING first(value) GROUP BY Date ORDER BY Date"""
+    return con.execute(query)
+
+
+def ensemble(data):
+    """
+    Recompute the ensemble mean and spread of comparison series from the series of every
+    source, as needed after aggregating them over time
+
+    Parameters:
+    data (pandas dataframe): Comparison series, with columns named as in query_comparison
+
+    Returns:
+    ensemble (pandas dataframe): Series of every source with their ensemble mean and sample
+    standard deviation across sources, one column per unit and series in alphabetical order
+    """
+    sources = data[[col for col in data.columns if col.rsplit('_', 1)[-1] in COMPARISON_SOURCES]]
+    panel = sources.T.groupby(sources.columns.str.rsplit('_', n=1).str[0])
+    return pd.concat([sources, panel.mean().T.add_suffix('_mean'), panel.std(ddof=1).T.add_suffix('_spread')],
+                     axis=1).sort_index(axis=1)
@@ -0,0 +1,136 @@
+"""
+Spatial index of the geographical units, for map-driven selection of the data columns
+
+The index is an STRtree over the shapes of the hot store (script/hot_store.py), whose WKB
+geometries are converted once per geographical resolution and shared by all processes. Trees
+are built once per process, and rebuilt only if the file of the shapes changes. Queries
+return the GID codes of the units, which are column names of the data files.
+
+Run from the root of the repository:
+
+    python -m script.spatial_index bbox -10 35 30 60
+    python -m script.spatial_index point 12.5 41.9
+    python -m script.spatial_index nearest -30 40
+"""
+
+import argparse
+import functools
+import os
+import time
+
+import numpy as np
+import shapely
+
+from script import hot_store
+
+
+def available(geo_resolution):
+    """
+    Return whether the shapes of a geographical resolution are in the repository
+    """
+    return os.path.exists(hot_store.geometries_source(geo_resolution))
+
+
+@functools.lru_cache(maxsize=4)
+def _index(geo_resolution, version):
+    table = hot_store.geometries(geo_resolution)
+    id_col = 'GID_1' if geo_resolution == 'gadm1' else 'GID_0'
+    ids = np.asarray(table.column(id_col).to_pylist(), dtype=object)
+    shapes = shapely.from_wkb(table.column('geometry').to_numpy(zero_copy_only=False))
+    return shapely.STRtree(shapes), ids
+
+
+def index(geo_resolution):
+    """
+    Return the STRtree of a geographical resolution and the GID codes of its geometries
+
+    Parameters:
+    geo_resolution (str): Geographical resolution of the units ('gadm0' or 'gadm1')
+
+    Returns:
+    tree (shapely STRtree): Tree over the geometries of the units
+    ids (numpy array): GID codes, in the order of the geometries of the tree
+    """
+    return _index(geo_resolution, hot_store.file_hash(hot_store.geometries_source(geo_resolution)))
+
+
+def geometries(geo_resolution):
+    """
+    Return the shapely geometries of a geographical resolution, in the order of the rows of
+    its hot store table. They are the geometries of the index, decoded once per process
+
+    Returns:
+    geometries (numpy array): Geometries of the units
+    """
+    return index(geo_resolution)[0].geometries
+
+
+def bbox(geo_resolution, west, south, east, north):
+    """
+    Return the units intersecting a bounding box, in longitude and latitude degrees. Boxes
+    with west greater than east cross the antimeridian, and are queried as the two boxes
+    on either side of it
+
+    Returns:
+    ids (list): Sorted GID codes of the units
+    """
+    if south > north:
+        raise ValueError(f'South ({south}) must not be greater than north ({north})')
+    tree, ids = index(geo_resolution)
+    if west > east:
+        boxes = [shapely.box(west, south, 180, north), shapely.box(-180, south, east, north)]
+    else:
+        boxes = [shapely.box(west, south, east, north)]
+    hits = np.unique(np.concatenate([tree.query(box, predicate='intersects') for box in boxes]))
+    return sorted(ids[hits].tolist())
+
+
+def point(geo_resolution, lon, lat):
+    """
+    Return the units containing a point, in longitude and latitude degrees. Points on a
+    border belong to all the units sharing it
+
+    Returns:
+    ids (list): Sorted GID codes of the units
+    """
+    tree, ids = index(geo_resolution)
+    hits = tree.query(shapely.Point(lon, lat), predicate='intersects')
+    return sorted(ids[hits].tolist())
+
+
+def nearest(geo_resolution, lon, lat):
+    """
+    Return the units nearest to a point, in longitude and latitude degrees: the units
+    containing it, or the closest ones (all of them in case of ties)
+
+    Returns:
+    ids (list): Sorted GID codes of the units
+    """
+    tree, ids = index(geo_resolution)
+    hits = tree.query_nearest(shapely.Point(lon, lat), all_matches=True)
+    return sorted(ids[hits].tolist())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Query the spatial index of the geographical units')
+    parser.add_argument('--geo-resolution', default='gadm0', choices=('gadm0', 'gadm1'))
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    bbox_parser = subparsers.add_parser('bbox', help='Units intersecting a bounding box')
+    for name in ('west', 'south', 'east', 'north'):
+        bbox_parser.add_argument(name, type=float)
+    for command in ('point', 'nearest'):
+        point_parser = subparsers.add_parser(command, help=f'Units {"containing" if command == "point" else "nearest to"} a point')
+        point_parser.add_argument('lon', type=float)
+        point_parser.add_argument('lat', type=float)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    index(args.geo_resolution)
+    built = time.perf_counter()
+    if args.command == 'bbox':
+        result = bbox(args.geo_resolution, args.west, args.south, args.east, args.north)
+    else:
+        result = globals()[args.command](args.geo_resolution, args.lon, args.lat)
+    done = time.perf_counter()
+    print(' '.join(result))
+    print(f'{len(result)} units, index loaded in {(built - start) * 1000:.1f} ms, query in {(done - built) * 1000:.2f} ms')
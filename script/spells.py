@@ -0,0 +1,193 @@
+"""
+Spell statistics of daily data: runs of consecutive days over a threshold, such as heatwaves
+(temperature) or wet spells (precipitation)
+
+Exceedances of all the units are run-length encoded at once with NumPy: the boolean matrix
+of days over the threshold is padded with a day under it at both ends of every unit, so its
+changes along time alternate between the onset and the end of every spell. Spells
+are attributed to the period (year or month) of their onset, also when they last beyond it.
+
+Run from the root of the repository:
+
+    python -m script.spells benchmark
+"""
+
+import argparse
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from script import hot_store, retrieval
+
+STATISTICS = ('longest spell', 'number of spells', 'first spell onset')
+
+PERIODS = {'yearly': 'Y', 'monthly': 'M'}
+
+
+def run_lengths(values, limits, min_length=1):
+    """
+    Run-length encode the days over the threshold of all units at once
+
+    Parameters:
+    values (numpy array): Daily values, shape (n_days, n_units); missing values break spells
+    limits (float or numpy array): Threshold, shared or one per unit
+    min_length (int): Minimum number of consecutive days of a spell
+
+    Returns:
+    units (numpy array): Column index of the unit of every spell
+    onsets (numpy array): Row index of the first day of every spell
+    lengths (numpy array): Number of days of every spell
+    """
+    exceed = np.asarray(values) > np.asarray(limits)
+    padded = np.zeros((exceed.shape[1], exceed.shape[0] + 2), dtype=bool)
+    padded[:, 1:-1] = exceed.T
+    # Changes come unit by unit in time order, as onset, end, onset, end...
+    units, changes = np.nonzero(padded[:, 1:] != padded[:, :-1])
+    units, onsets, lengths = units[0::2], changes[0::2], changes[1::2] - changes[0::2]
+    keep = lengths >= min_length
+    return units[keep], onsets[keep], lengths[keep]
+
+
+def spell_table(data, limits, min_length=1):
+    """
+    Return the spells of every unit of a daily dataframe
+
+    Parameters:
+    data (pandas dataframe): Daily values with dates as index and units as columns
+    limits (float or pandas series): Threshold, shared or one per unit (indexed by unit)
+    min_length (int): Minimum number of consecutive days of a spell
+
+    Returns:
+    spells (pandas dataframe): One row per spell, with columns unit, onset, end and length
+    """
+    if isinstance(limits, pd.Series):
+        limits = limits.reindex(data.columns).to_numpy()
+    units, onsets, lengths = run_lengths(data.to_numpy(dtype=float), limits, min_length)
+    return pd.DataFrame({'unit': data.columns.to_numpy()[units],
+                         'onset': data.index[onsets],
+                         'end': data.index[onsets + lengths - 1],
+                         'length': lengths})
+
+
+def spell_statistics(data, limits, statistic, min_length=1, time_frequency='yearly'):
+    """
+    Summarize the spells of every unit by year or month
+
+    Parameters:
+    data (pandas dataframe): Daily values with dates as index and units as columns
+    limits (float or pandas series): Threshold, shared or one per unit (indexed by unit)
+    statistic (str): 'longest spell' (days), 'number of spells' or 'first spell onset'
+    (day of the year, missing if no spell starts in the period)
+    min_length (int): Minimum number of consecutive days of a spell
+    time_frequency (str): Period of the summary, either 'yearly' or 'monthly'
+
+    Returns:
+    summary (pandas dataframe): Statistic with period end dates as index and units as columns
+    """
+    if isinstance(limits, pd.Series):
+        limits = limits.reindex(data.columns).to_numpy()
+    spells = run_lengths(data.to_numpy(dtype=float), limits, min_length)
+    return summarize(data.index, data.columns, spells, statistic, time_frequency)
+
+
+def summarize(index, columns, spells, statistic, time_frequency='yearly'):
+    """
+    Summarize run-length encoded spells by year or month, with NumPy reductions over one
+    cell per period and unit
+
+    Parameters:
+    index (pandas DatetimeIndex): Daily dates of the encoded data
+    columns (pandas Index): Units of the encoded data
+    spells (tuple): Units, onsets and lengths returned by run_lengths
+    statistic (str): 'longest spell', 'number of spells' or 'first spell onset'
+    time_frequency (str): Period of the summary, either 'yearly' or 'monthly'
+
+    Returns:
+    summary (pandas dataframe): Statistic with period end dates as index and units as columns
+    """
+    units, onsets, lengths = spells
+    codes, periods = pd.factorize(index.to_period(PERIODS[time_frequency]))
+    size = len(periods) * len(columns)
+    cells = codes[onsets] * len(columns) + units
+    if statistic == 'longest spell':
+        summary = np.zeros(size, dtype=int)
+        np.maximum.at(summary, cells, lengths)
+    elif statistic == 'number of spells':
+        summary = np.bincount(cells, minlength=size)
+    else:
+        summary = np.full(size, np.nan)
+        np.fmin.at(summary, cells, index.dayofyear.to_numpy()[onsets])
+    return pd.DataFrame(summary.reshape(len(periods), len(columns)), index=periods.end_time.normalize(), columns=columns)
+
+
+def _loop_statistics(data, limits, min_length):
+    # Per-unit Python loop, as a reference for the benchmark only
+    result = {}
+    for unit in data.columns:
+        longest, run = 0, 0
+        for value in data[unit].to_numpy() > limits[unit]:
+            run = run + 1 if value else 0
+            longest = max(longest, run)
+        result[unit] = longest if longest >= min_length else 0
+    return result
+
+
+def benchmark(file, min_length, loop_units):
+    """
+    Time percentile thresholds and yearly spell statistics over all the units and the full
+    history of a daily data file. Data files that are not available (or Git LFS pointers)
+    are replaced by random data of the same shape, with the dates of the catalog
+    """
+    freq = 'daily'
+    try:
+        data = hot_store.dataset(retrieval.dataset_files(file)).to_pandas()
+        data.index = pd.to_datetime(data.pop('Date'), format='X%Y%m%d')
+        label = file
+    except (OSError, pa.ArrowInvalid):
+        start, end = retrieval.coverage('era', freq)
+        geo_resolution = os.path.basename(file).split('_')[0]
+        if geo_resolution == 'gadm0':
+            units = retrieval.file_units(file.replace('_daily', '_monthly'))
+        else:
+            units = pd.read_csv('./poly/gadm1_adm.csv')['GID_1'].astype(str).str.replace('.', '_').tolist()
+        dates = pd.date_range(start, end, freq='D')
+        rng = np.random.default_rng(0)
+        seasonal = 15 - 10 * np.cos(2 * np.pi * dates.dayofyear.to_numpy() / 365.25)
+        data = pd.DataFrame(seasonal[:, None] + rng.normal(0, 3, (len(dates), len(units))).cumsum(axis=0) * 0.05
+                            + rng.normal(0, 2, (len(dates), len(units))), index=dates, columns=units)
+        label = f'random data shaped as {os.path.basename(file)}'
+    print(f'{label}: {data.shape[1]} units x {data.shape[0]} days')
+
+    start_time = time.perf_counter()
+    limits = data.quantile(q=0.9)
+    thresholds = time.perf_counter()
+    spells = run_lengths(data.to_numpy(dtype=float), limits.to_numpy(), min_length)
+    encoded = time.perf_counter()
+    summaries = {statistic: summarize(data.index, data.columns, spells, statistic) for statistic in STATISTICS}
+    summarized = time.perf_counter()
+    print(f'percentile thresholds {(thresholds - start_time) * 1000:.0f} ms, '
+          f'run-length encoding {(encoded - thresholds) * 1000:.0f} ms ({len(spells[0])} spells of at least {min_length} days), '
+          f'{len(summaries)} yearly statistics {(summarized - encoded) * 1000:.0f} ms')
+
+    if loop_units:
+        subset = data.iloc[:, :loop_units]
+        loop_start = time.perf_counter()
+        longest = _loop_statistics(subset, limits, min_length)
+        loop_time = (time.perf_counter() - loop_start) * data.shape[1] / subset.shape[1]
+        whole = spell_table(subset, limits, min_length).groupby('unit')['length'].max()
+        assert all(longest[unit] == whole.get(unit, 0) for unit in subset.columns)
+        print(f'per-unit Python loop (longest spell only, extrapolated to all units): {loop_time * 1000:.0f} ms')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Spell statistics of daily data')
+    parser.add_argument('command', choices=('benchmark',))
+    parser.add_argument('--file', default='./data/gadm0_era_tmp_pop_2015_daily.parquet', help='Daily data file')
+    parser.add_argument('--min-length', type=int, default=3, help='Minimum number of consecutive days of a spell')
+    parser.add_argument('--loop-units', type=int, default=10,
+                        help='Units timed with a per-unit Python loop for comparison (0 to skip)')
+    args = parser.parse_args()
+    benchmark(args.file, args.min_length, args.loop_units)